@@ -7,12 +7,43 @@ Extracts addresses from .mhtml filenames and serves them via API.
 import os
 import re
 import json
+import base64
+import html
+import traceback
+import functools
+import hashlib
+import gzip
+import threading
+import shutil
+import tempfile
 import email
 from email import policy
-from flask import Flask, send_file, jsonify, send_from_directory, Response
+from email.parser import BytesFeedParser
+from html.parser import HTMLParser
+from flask import Flask, send_file, jsonify, send_from_directory, Response, request
 from flask_cors import CORS
+from collections import OrderedDict
 from pathlib import Path
-from time import time
+from time import sleep
+
+try:
+    # SIMD-accelerated base64 encoder that returns str directly (no extra decode copy)
+    from pybase64 import b64encode_as_string
+except ImportError:
+    def b64encode_as_string(data):
+        return base64.b64encode(data).decode('ascii')
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    # Fast JSON encoder that produces UTF-8 bytes directly
+    from orjson import dumps as json_dumps_bytes
+except ImportError:
+    def json_dumps_bytes(obj):
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
 
 app = Flask(__name__)
 CORS(app)
@@ -20,20 +51,68 @@ CORS(app)
 # Base directory for mhtml files
 BASE_DIR = Path(__file__).parent
 
-# Cache for properties list (to avoid rescanning on every request)
-_properties_cache = None
-_cache_timestamp = 0
-CACHE_DURATION = 5  # Cache for 5 seconds
+# Pre-encoded /api/properties response, built at import and rebuilt by a background
+# watcher when the directory mtime changes (adding, removing or renaming a file updates it)
+_PROPERTIES_JSON = b''
+_properties_mtime = -1
+_watcher_pid = None
+WATCH_INTERVAL = 2  # Seconds between directory mtime checks
+
+# Extracted HTML larger than this is spilled to MHTML_CACHE_DIR and served with send_file
+# instead of being held in memory. Each process spills into its own tmp/<pid> subdirectory.
+MHTML_CACHE_DIR = BASE_DIR / 'tmp'
+SPILL_THRESHOLD = 8 * 1024 * 1024  # 8 MB
+# Pages larger than this keep only a gzip copy next to the identity body (no brotli copy)
+MULTI_ENCODING_THRESHOLD = 1024 * 1024  # 1 MB
+# Upper bound on the bytes held by the in-memory render cache (per process)
+RENDER_CACHE_MAX_BYTES = 256 * 1024 * 1024  # 256 MB
+# Upper bound on the number of cached pages, which also limits the spilled files kept on disk
+RENDER_CACHE_MAX_ENTRIES = 64
+
+# Render cache: (path, mtime_ns, size) -> render_mhtml result, in LRU order
+_render_cache = OrderedDict()
+_render_cache_bytes = 0
+_render_cache_lock = threading.Lock()
+
+# Read size when feeding mhtml files to the MIME parser
+PARSE_CHUNK_SIZE = 1024 * 1024  # 1 MB
+
+# Compression level for the pre-compressed copies of extracted HTML (brotli quality / gzip level)
+COMPRESSION_LEVEL = 5
+
+# Precompiled patterns (compiled once at import instead of on every request)
+# Filename pattern: "For sale_" followed by address until the next " - "
+_ADDRESS_RE = re.compile(r'For sale_\s*(.+?)\s*-\s*\d+')
+# Leftover quoted-printable artifacts: escaped "=" and soft line breaks
+_QP_RESIDUE_RE = re.compile(r'=3D|=\r?\n')
+# src / link href values pointing at an embedded part, either by cid: or by external URL
+_RESOURCE_URL_RE = re.compile(r'cid:(?P<cid>.+)|(?P<url>https?://.+)', re.IGNORECASE | re.DOTALL)
+# url(cid:...) references inside a style value
+_URL_CID_RE = re.compile(r'url\(cid:([^)]+)\)', re.IGNORECASE)
+# Marked sections that HTMLParser closes with "]]>" (everything else closes with "]>")
+_DOUBLE_BRACKET_SECTIONS = frozenset(('temp', 'cdata', 'ignore', 'include', 'rcdata'))
+# MIME boundary parameter in the raw mhtml header
+_BOUNDARY_RE = re.compile(r'boundary=["\']?([^"\'\s;]+)', re.IGNORECASE)
+
+
+def _replace_qp_residue(match):
+    """Map =3D to = and drop =\\n soft line breaks"""
+    return '=' if match.group(0) == '=3D' else ''
 
 
+def _norm_cid(cid):
+    """Normalize a Content-ID / cid: reference to a single lookup key (no < >, no cid: prefix)"""
+    cid = cid.strip('<>')
+    return cid[4:] if cid.startswith('cid:') else cid
+
+
+@functools.lru_cache(maxsize=4096)
 def extract_address_from_filename(filename):
     """
     Extract address from filename pattern: "For sale_ <address> - <number>"
     Returns the address string or None if pattern doesn't match.
     """
-    # Pattern: "For sale_" followed by address until the next " - "
-    pattern = r'For sale_\s*(.+?)\s*-\s*\d+'
-    match = re.search(pattern, filename)
+    match = _ADDRESS_RE.search(filename)
     if match:
         return match.group(1).strip()
     return None
@@ -47,20 +126,64 @@ def scan_mhtml_files():
     """
     properties = []
     
-    for file_path in BASE_DIR.glob('*.mhtml'):
-        filename = file_path.name
-        address = extract_address_from_filename(filename)
-        
-        if address:
-            properties.append({
-                'filename': filename,
-                'address': address,
-                'filepath': str(file_path)
-            })
+    with os.scandir(BASE_DIR) as entries:
+        for entry in entries:
+            filename = entry.name
+            if not filename.endswith('.mhtml'):
+                continue
+            address = extract_address_from_filename(filename)
+            
+            if address:
+                properties.append({
+                    'filename': filename,
+                    'address': address,
+                    'filepath': entry.path
+                })
     
     return properties
 
 
+def _rebuild_properties():
+    """Rescan the directory and replace the pre-encoded properties JSON."""
+    global _PROPERTIES_JSON, _properties_mtime
+    
+    # Read the mtime before scanning so a change during the scan triggers another rebuild
+    mtime = os.stat(BASE_DIR).st_mtime_ns
+    _PROPERTIES_JSON = json_dumps_bytes(scan_mhtml_files())
+    _properties_mtime = mtime
+
+
+def _watch_properties():
+    """Poll the directory mtime and rebuild the properties JSON when it changes."""
+    while True:
+        sleep(WATCH_INTERVAL)
+        try:
+            if os.stat(BASE_DIR).st_mtime_ns != _properties_mtime:
+                _rebuild_properties()
+        except Exception as e:
+            print(f"Error rebuilding properties: {e}")
+            traceback.print_exc()
+
+
+def _start_properties_watcher():
+    """
+    Start the watcher thread for this process.
+    Threads don't survive fork(), so each forked worker (e.g. under gunicorn --preload)
+    rescans and starts its own on first use.
+    """
+    global _watcher_pid
+    
+    if _watcher_pid == os.getpid():
+        return
+    _watcher_pid = os.getpid()
+    # Catch up on anything that changed between the parent's scan and the fork
+    _rebuild_properties()
+    threading.Thread(target=_watch_properties, name='properties-watcher', daemon=True).start()
+
+
+_start_properties_watcher()
+
+
 @app.route('/')
 def index():
     """Serve the main HTML page."""
@@ -72,250 +195,405 @@ def get_properties():
     """
     API endpoint to get all properties with addresses.
     Returns JSON array of properties.
-    Uses caching to avoid rescanning files on every request.
+    The JSON is pre-encoded and kept up to date by a background watcher, so no work is done per request.
     """
-    global _properties_cache, _cache_timestamp
-    
-    current_time = time()
-    # Refresh cache if it's expired or doesn't exist
-    if _properties_cache is None or (current_time - _cache_timestamp) > CACHE_DURATION:
-        _properties_cache = scan_mhtml_files()
-        _cache_timestamp = current_time
-    
-    return jsonify(_properties_cache)
+    _start_properties_watcher()
+    return Response(_PROPERTIES_JSON, mimetype='application/json')
+
+
+class _LazyPart:
+    """
+    An embedded mhtml part whose payload is only decoded, and whose data URL is only
+    built, the first time the HTML references it. Unreferenced parts are never encoded
+    and a part referenced many times is encoded once.
+    """
+
+    __slots__ = ('_part', '_payload', '_url')
+
+    def __init__(self, part):
+        self._part = part
+        self._payload = None
+        self._url = None
+
+    @property
+    def content_type(self):
+        return self._part.get_content_type()
+
+    @property
+    def charset(self):
+        return self._part.get_content_charset() or 'utf-8'
+
+    def payload(self):
+        if self._payload is None:
+            self._payload = self._part.get_payload(decode=True) or b''
+        return self._payload
+
+    def data_url(self):
+        """Return the part as a data: URL, or None if it has no payload"""
+        if self._url is None:
+            payload = self.payload()
+            if not payload:
+                return None
+            base64_data = b64encode_as_string(payload)
+            self._url = f'data:{self.content_type};base64,{base64_data}'
+        return self._url
+
+
+class MhtmlHtmlRewriter(HTMLParser):
+    """
+    Rewrite the HTML part of an mhtml file in a single pass.
+    Tags that reference embedded resources are rebuilt with data URLs (or inlined CSS);
+    everything else is copied through unchanged. Output is written as UTF-8 straight
+    into a bytearray, so the document is never rebuilt as an intermediate str.
+    """
+
+    def __init__(self, get_part, get_location_part):
+        super().__init__(convert_charrefs=False)
+        self._get_part = get_part
+        self._get_location_part = get_location_part
+        self._out = bytearray()
+        # CSS content to inject before </head>
+        self._css_injections = []
+        self._css_cids_processed = set()
+
+    def get_html(self):
+        """Return the rewritten HTML as UTF-8 bytes, injecting CSS at the end if no </head> was seen."""
+        if self._css_injections:
+            self._out += b'\n'.join(self._css_injections)
+            self._css_injections = []
+        return bytes(self._out)
+
+    def _emit(self, fragment):
+        self._out += fragment.encode('utf-8')
+
+    def _cid_data_url(self, cid_url):
+        part = self._get_part(cid_url)
+        return part.data_url() if part else None
+
+    def _url_data_url(self, url):
+        """Data URL for an external URL if it's embedded in the mhtml, otherwise None"""
+        part = self._get_location_part(url)
+        return part.data_url() if part else None
+
+    def _inline_css_link(self, attrs):
+        """Collect the CSS for a cid: stylesheet link. Returns True if the link tag should be dropped."""
+        href = next((value for name, value in attrs if name == 'href'), None)
+        if not href or not href.lower().startswith('cid:'):
+            return False
+        cid_url = href[4:]
+        part = self._get_part(cid_url)
+        if not (part and part.content_type == 'text/css' and part.payload()):
+            return False
+        if cid_url not in self._css_cids_processed:
+            try:
+                css_content = part.payload().decode(part.charset)
+                self._css_injections.append(
+                    b'<style type="text/css">' + css_content.encode('utf-8') + b'</style>'
+                )
+                self._css_cids_processed.add(cid_url)
+            except Exception as e:
+                print(f"Error decoding CSS for {cid_url}: {e}")
+        return True
+
+    def _rewrite_attr(self, tag, name, value):
+        """Return the rewritten attribute value, or None if it doesn't need rewriting"""
+        # Any *src attribute (src, data-src, lowsrc, ...) is a resource reference, so
+        # lazy-loaded images are inlined too. srcset isn't handled
+        if not value or not (
+            name == 'style' or name.endswith('src') or (name == 'href' and tag == 'link')
+        ):
+            return None
+        
+        new_value = None
+        if name == 'style':
+            if 'cid:' in value.lower():
+                # Only the (small) style value is scanned, not the whole document
+                def replace_style_cid(m):
+                    data_url = self._cid_data_url(m.group(1))
+                    return f'url({data_url})' if data_url else m.group(0)
+                new_value = _URL_CID_RE.sub(replace_style_cid, value)
+                if new_value == value:
+                    new_value = None
+        else:
+            # One match decides between the cid: and the Content-Location lookup
+            match = _RESOURCE_URL_RE.match(value)
+            if match:
+                if match.group('cid') is not None:
+                    new_value = self._cid_data_url(match.group('cid'))
+                else:
+                    new_value = self._url_data_url(match.group('url'))
+        return new_value
+
+    def _handle_tag(self, tag, attrs, self_closing):
+        if tag == 'link' and self._inline_css_link(attrs):
+            return
+        new_attrs = []
+        changed = False
+        for name, value in attrs:
+            new_value = self._rewrite_attr(tag, name, value)
+            if new_value is not None:
+                value = new_value
+                changed = True
+            new_attrs.append((name, value))
+        if not changed:
+            self._emit(self.get_starttag_text())
+            return
+        parts = [tag]
+        for name, value in new_attrs:
+            if value is None:
+                parts.append(name)
+            else:
+                parts.append(f'{name}="{html.escape(value, quote=True)}"')
+        self._emit('<' + ' '.join(parts) + (' />' if self_closing else '>'))
+
+    def handle_starttag(self, tag, attrs):
+        self._handle_tag(tag, attrs, False)
+
+    def handle_startendtag(self, tag, attrs):
+        self._handle_tag(tag, attrs, True)
+
+    def parse_marked_section(self, i, report=1):
+        # The base parser asserts on unknown "<![" sections (e.g. "<![x]>"); browsers
+        # treat them as bogus comments, so pass the "<![" through as text and carry on
+        try:
+            return super().parse_marked_section(i, report)
+        except AssertionError:
+            self.handle_data('<![')
+            return i + 3
+
+    def handle_endtag(self, tag):
+        if tag == 'head' and self._css_injections:
+            # Inject all CSS before </head>
+            self._out += b'\n'.join(self._css_injections) + b'\n'
+            self._css_injections = []
+        self._emit(f'</{tag}>')
+
+    def handle_data(self, data):
+        self._emit(data)
+
+    def handle_entityref(self, name):
+        self._emit(f'&{name};')
+
+    def handle_charref(self, name):
+        self._emit(f'&#{name};')
+
+    def handle_comment(self, data):
+        self._emit(f'<!--{data}-->')
+
+    def handle_decl(self, decl):
+        self._emit(f'<!{decl}>')
+
+    def handle_pi(self, data):
+        self._emit(f'<?{data}>')
+
+    def unknown_decl(self, data):
+        # HTMLParser strips "]]>" from CDATA-style sections but only "]>" from
+        # conditional ones such as <![if !IE]> / <![endif]>
+        section = data.split('[', 1)[0].strip().lower()
+        close = ']]>' if section in _DOUBLE_BRACKET_SECTIONS else ']>'
+        self._emit(f'<![{data}{close}')
 
 
 def extract_html_from_mhtml(file_path):
     """
     Extract HTML content from mhtml file and convert embedded resources to data URLs.
-    Returns the HTML content as a string with cid: URLs replaced with data URLs, or None if extraction fails.
+    Returns the HTML content as UTF-8 bytes with cid: URLs replaced with data URLs, or None if extraction fails.
     """
     try:
-        import base64
-        
+        # Feed the parser in chunks rather than reading the whole file into a bytes
+        # object first, so the raw file contents never sit alongside the parsed parts.
+        # (message_from_binary_file would also translate CRLF line endings.)
+        parser = BytesFeedParser(policy=policy.default)
         with open(file_path, 'rb') as f:
-            msg = email.message_from_bytes(f.read(), policy=policy.default)
+            for chunk in iter(lambda: f.read(PARSE_CHUNK_SIZE), b''):
+                parser.feed(chunk)
+        msg = parser.close()
         
         # Store all parts by Content-ID and Content-Location for lookup
         parts_by_cid = {}
         parts_by_location = {}  # Index by Content-Location URL
         html_content = None
-        html_charset = 'utf-8'
         
-        # First pass: extract all parts
+        # First pass: find the HTML document and index the other parts
+        # (payloads are decoded lazily on first reference)
         for part in msg.walk():
+            # multipart/* containers only wrap the parts that follow
+            if part.is_multipart():
+                continue
+            
+            content_type = part.get_content_type()
+            
+            # Find HTML part. It's the document being rewritten, not a resource, so it isn't indexed
+            if content_type == 'text/html' and html_content is None:
+                payload = part.get_payload(decode=True)
+                if payload:
+                    charset = part.get_content_charset() or 'utf-8'
+                    # get_payload(decode=True) has already undone the Content-Transfer-Encoding
+                    # (quoted-printable or base64), so only the charset decode is left
+                    try:
+                        html_content = payload.decode(charset)
+                    except UnicodeDecodeError:
+                        html_content = payload.decode('utf-8', errors='ignore')
+                    continue
+            
             content_id = part.get('Content-ID', '')
             content_location = part.get('Content-Location', '')
-            content_type = part.get_content_type()
+            lazy_part = _LazyPart(part)
             
-            # Clean Content-ID (remove < >)
+            # Index by normalized Content-ID
             if content_id:
-                content_id = content_id.strip('<>')
-                parts_by_cid[content_id] = part
-                # Also store without cid: prefix if present
-                if content_id.startswith('cid:'):
-                    parts_by_cid[content_id[4:]] = part
+                parts_by_cid[_norm_cid(content_id)] = lazy_part
             
             # Index by Content-Location URL (for matching external URLs)
             if content_location:
                 # Store full URL
-                parts_by_location[content_location] = part
+                parts_by_location[content_location] = lazy_part
                 # Also store URL without query parameters (some URLs have ?v=...)
                 if '?' in content_location:
                     base_url = content_location.split('?')[0]
-                    parts_by_location[base_url] = part
-                # Remove cid: prefix if present and store
-                if content_location.startswith('cid:'):
-                    loc_key = content_location[4:]
-                    parts_by_cid[loc_key] = part
-                else:
-                    # Also store in cid dict for backward compatibility
-                    parts_by_cid[content_location] = part
-            
-            # Find HTML part
-            if content_type == 'text/html' and html_content is None:
-                payload = part.get_payload(decode=True)
-                if payload:
-                    charset = part.get_content_charset() or 'utf-8'
-                    html_charset = charset
-                    try:
-                        html_content = payload.decode(charset)
-                    except UnicodeDecodeError:
-                        html_content = payload.decode('utf-8', errors='ignore')
-                    
-                    # If content still has quoted-printable encoding markers, decode them
-                    # The email library should handle this, but sometimes =3D remains
-                    import quopri
-                    try:
-                        # Try to decode any remaining quoted-printable
-                        html_content = quopri.decodestring(html_content.encode('utf-8')).decode('utf-8', errors='ignore')
-                    except:
-                        pass
+                    parts_by_location[base_url] = lazy_part
+                # Also store in cid dict so cid: references to a Content-Location resolve
+                parts_by_cid[_norm_cid(content_location)] = lazy_part
         
         if not html_content:
             return None
         
-        # Clean up any remaining quoted-printable artifacts
-        html_content = html_content.replace('=3D', '=').replace('=\n', '')
+        # Clean up quoted-printable artifacts left after decoding, in a single pass.
+        # Only pages that still contain =3D" / =3D' need it, so clean files cost one substring scan
+        if '=3D"' in html_content or "=3D'" in html_content:
+            html_content = _QP_RESIDUE_RE.sub(_replace_qp_residue, html_content)
         
         # Second pass: replace cid: URLs with data URLs or inline content
-        import re
-        
-        def get_part_content(cid):
-            """Get content for a Content-ID"""
-            # Try exact match first
-            if cid in parts_by_cid:
-                part = parts_by_cid[cid]
-                payload = part.get_payload(decode=True)
-                content_type = part.get_content_type()
-                return part, payload, content_type
-            
-            # Try with cid: prefix removed
-            if cid.startswith('cid:'):
-                cid_clean = cid[4:]
-                if cid_clean in parts_by_cid:
-                    part = parts_by_cid[cid_clean]
-                    payload = part.get_payload(decode=True)
-                    content_type = part.get_content_type()
-                    return part, payload, content_type
-            
-            # Try adding cid: prefix
-            cid_with_prefix = f'cid:{cid}'
-            if cid_with_prefix in parts_by_cid:
-                part = parts_by_cid[cid_with_prefix]
-                payload = part.get_payload(decode=True)
-                content_type = part.get_content_type()
-                return part, payload, content_type
-            
-            return None, None, None
-        
-        # Collect CSS content to inject
-        css_injections = []
-        css_cids_processed = set()
-        
-        def replace_css_link(match):
-            """Replace CSS link tag with cid: URL"""
-            full_match = match.group(0)
-            cid_url = match.group(1)  # Content-ID from href
-            
-            part, payload, content_type = get_part_content(cid_url)
-            if part and payload and content_type == 'text/css':
-                if cid_url not in css_cids_processed:
-                    try:
-                        charset = part.get_content_charset() or 'utf-8'
-                        css_content = payload.decode(charset)
-                        css_injections.append(f'<style type="text/css">{css_content}</style>')
-                        css_cids_processed.add(cid_url)
-                    except Exception as e:
-                        print(f"Error decoding CSS for {cid_url}: {e}")
-                # Remove the link tag
-                return ''
-            return full_match
+        def get_part(cid):
+            """Get the part for a Content-ID"""
+            return parts_by_cid.get(_norm_cid(cid))
         
-        def replace_cid_src(match):
-            """Replace cid: URL in src attribute"""
-            attr_name = match.group(1)  # src
-            cid_url = match.group(2)  # Content-ID
-            
-            part, payload, content_type = get_part_content(cid_url)
-            if part and payload:
-                # For images and other resources, use data URL
-                base64_data = base64.b64encode(payload).decode('utf-8')
-                return f'{attr_name}="data:{content_type};base64,{base64_data}"'
-            
-            return match.group(0)
-        
-        def replace_external_url(match):
-            """Replace external URL with data URL if it's embedded in mhtml"""
-            attr_name = match.group(1)  # src or href
-            url = match.group(2)  # External URL
-            
-            # Check if this URL is embedded in the mhtml file
-            part = None
+        def get_location_part(url):
+            """Get the part embedded for an external URL (by Content-Location)"""
             if url in parts_by_location:
-                part = parts_by_location[url]
-            elif '?' in url:
+                return parts_by_location[url]
+            if '?' in url:
                 # Try without query parameters
-                base_url = url.split('?')[0]
-                if base_url in parts_by_location:
-                    part = parts_by_location[base_url]
-            
-            if part:
-                payload = part.get_payload(decode=True)
-                content_type = part.get_content_type()
-                if payload:
-                    base64_data = base64.b64encode(payload).decode('utf-8')
-                    return f'{attr_name}="data:{content_type};base64,{base64_data}"'
-            
-            # Not found in mhtml, return original URL
-            return match.group(0)
-        
-        # Replace CSS link tags with cid: URLs (handle quoted-printable encoding =3D)
-        # Pattern matches: href="cid:..." or href=3D"cid:..." (quoted-printable)
-        html_content = re.sub(
-            r'<link[^>]*href=3?D?["\']cid:([^"\']+)["\'][^>]*>',
-            replace_css_link,
-            html_content,
-            flags=re.IGNORECASE
-        )
-        
-        # Replace cid: URLs in img src and other src attributes
-        # Handle both normal and quoted-printable encoded (=3D)
-        html_content = re.sub(
-            r'(src)=3?D?["\']cid:([^"\']+)["\']',
-            replace_cid_src,
-            html_content,
-            flags=re.IGNORECASE
-        )
-        
-        # Replace external image URLs that are embedded in mhtml (by Content-Location)
-        # Match src="https://..." URLs
-        html_content = re.sub(
-            r'(src)=3?D?["\'](https?://[^"\']+)["\']',
-            replace_external_url,
-            html_content,
-            flags=re.IGNORECASE
-        )
-        
-        # Also handle background-image in style attributes
-        def replace_cid_in_style(match):
-            style_content = match.group(1)
-            # Find cid: URLs in style content
-            def replace_style_cid(m):
-                cid_url = m.group(1)
-                part, payload, content_type = get_part_content(cid_url)
-                if part and payload:
-                    base64_data = base64.b64encode(payload).decode('utf-8')
-                    return f'url(data:{content_type};base64,{base64_data})'
-                return m.group(0)
-            
-            style_content = re.sub(
-                r'url\(cid:([^)]+)\)',
-                replace_style_cid,
-                style_content,
-                flags=re.IGNORECASE
-            )
-            return f'style="{style_content}"'
-        
-        html_content = re.sub(
-            r'style=3?D?["\']([^"\']*cid:[^"\']*)["\']',
-            replace_cid_in_style,
-            html_content,
-            flags=re.IGNORECASE
-        )
-        
-        # Inject all CSS before </head>
-        if css_injections:
-            html_content = html_content.replace('</head>', '\n'.join(css_injections) + '\n</head>', 1)
+                return parts_by_location.get(url.split('?')[0])
+            return None
         
-        return html_content
+        rewriter = MhtmlHtmlRewriter(get_part, get_location_part)
+        rewriter.feed(html_content)
+        rewriter.close()
+        return rewriter.get_html()
     except Exception as e:
-        import traceback
         print(f"Error extracting HTML from mhtml: {e}")
         traceback.print_exc()
         return None
 
 
+def _render_mhtml_uncached(file_path):
+    """
+    Extract and encode the HTML for an mhtml file.
+    Returns a dict mapping content-coding ('identity', 'gzip' and, for pages up to
+    MULTI_ENCODING_THRESHOLD, 'br') to the encoded body, the Path of a spilled copy for
+    very large pages, or None if extraction fails.
+    """
+    body = extract_html_from_mhtml(file_path)
+    if not body:
+        return None
+    
+    if len(body) <= SPILL_THRESHOLD:
+        # Base64-heavy HTML compresses well, so compress once here rather than per request
+        bodies = {
+            'identity': body,
+            'gzip': gzip.compress(body, compresslevel=COMPRESSION_LEVEL),
+        }
+        if brotli is not None and len(body) <= MULTI_ENCODING_THRESHOLD:
+            bodies['br'] = brotli.compress(body, quality=COMPRESSION_LEVEL)
+        return bodies
+    
+    # Content-addressed filename, so identical output is only written once
+    spill_dir = MHTML_CACHE_DIR / str(os.getpid())
+    spill_path = spill_dir / f'{hashlib.sha1(body).hexdigest()}.html'
+    if not spill_path.exists():
+        spill_dir.mkdir(parents=True, exist_ok=True)
+        # Unique temp name, so concurrent renders of the same page don't collide
+        with tempfile.NamedTemporaryFile(dir=spill_dir, suffix='.tmp', delete=False) as f:
+            f.write(body)
+        os.replace(f.name, spill_path)
+    return spill_path
+
+
+def _render_size(rendered):
+    """Bytes of memory held by a render cache entry (spilled pages live on disk)"""
+    if isinstance(rendered, dict):
+        return sum(len(data) for data in rendered.values())
+    return 0
+
+
+def _evict_oldest_render():
+    """Drop the least recently used render; caller holds _render_cache_lock"""
+    global _render_cache_bytes
+    
+    _, rendered = _render_cache.popitem(last=False)
+    _render_cache_bytes -= _render_size(rendered)
+    # Delete a spilled copy unless another entry (same content) still uses it
+    if isinstance(rendered, Path) and rendered not in _render_cache.values():
+        rendered.unlink(missing_ok=True)
+
+
+def render_mhtml(file_path, mtime_ns, size):
+    """
+    Return the rendered HTML for an mhtml file (see _render_mhtml_uncached), cached by
+    (path, mtime, size). The cache is LRU and bounded by RENDER_CACHE_MAX_BYTES and
+    RENDER_CACHE_MAX_ENTRIES; evicted spill files are deleted.
+    """
+    global _render_cache_bytes
+    
+    key = (file_path, mtime_ns, size)
+    with _render_cache_lock:
+        if key in _render_cache:
+            rendered = _render_cache[key]
+            # Re-render if a spilled copy has gone missing from disk
+            if not isinstance(rendered, Path) or rendered.exists():
+                _render_cache.move_to_end(key)
+                return rendered
+    
+    rendered = _render_mhtml_uncached(file_path)
+    
+    with _render_cache_lock:
+        if key in _render_cache:
+            _render_cache_bytes -= _render_size(_render_cache[key])
+        _render_cache[key] = rendered
+        _render_cache.move_to_end(key)
+        _render_cache_bytes += _render_size(rendered)
+        while len(_render_cache) > 1 and (
+            _render_cache_bytes > RENDER_CACHE_MAX_BYTES
+            or len(_render_cache) > RENDER_CACHE_MAX_ENTRIES
+        ):
+            _evict_oldest_render()
+    return rendered
+
+
+def _prune_spill_dirs():
+    """Remove spill directories left behind by processes that are no longer running."""
+    if not MHTML_CACHE_DIR.is_dir():
+        return
+    for entry in MHTML_CACHE_DIR.iterdir():
+        if entry.is_dir() and entry.name.isdigit():
+            try:
+                os.kill(int(entry.name), 0)
+                continue
+            except ProcessLookupError:
+                pass
+            except PermissionError:
+                # Process exists but belongs to another user
+                continue
+        if entry.is_dir():
+            shutil.rmtree(entry, ignore_errors=True)
+        else:
+            entry.unlink(missing_ok=True)
+
+
+_prune_spill_dirs()
+
+
 @app.route('/mhtml/<path:filename>')
 def serve_mhtml(filename):
     """
@@ -328,54 +606,76 @@ def serve_mhtml(filename):
         if not os.path.abspath(file_path).startswith(os.path.abspath(BASE_DIR)):
             return jsonify({'error': 'Invalid file path'}), 403
         
-        # Extract HTML content from mhtml file
-        html_content = extract_html_from_mhtml(file_path)
+        # Extract HTML content from mhtml file (cached until the file changes)
+        st = os.stat(file_path)
+        rendered = render_mhtml(file_path, st.st_mtime_ns, st.st_size)
         
-        if html_content:
-            # Serve the extracted HTML content
+        if isinstance(rendered, Path):
+            # Very large page: let Werkzeug stream the spilled file
+            response = send_file(rendered, mimetype='text/html; charset=utf-8', conditional=True)
+            response.headers['Content-Disposition'] = 'inline'
+            response.headers['X-Content-Type-Options'] = 'nosniff'
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+        elif rendered:
+            # Serve the extracted HTML content (already encoded, so Flask doesn't re-encode it),
+            # pre-compressed if the client accepts it
+            encoding = request.accept_encodings.best_match(
+                [coding for coding in ('br', 'gzip') if coding in rendered],
+                default='identity'
+            )
+            headers = {
+                'Content-Type': 'text/html; charset=utf-8',
+                'Content-Disposition': 'inline',
+                'X-Content-Type-Options': 'nosniff',
+                'Cache-Control': 'no-cache',
+                'Vary': 'Accept-Encoding'
+            }
+            if encoding != 'identity':
+                headers['Content-Encoding'] = encoding
             return Response(
-                html_content,
+                rendered[encoding],
                 mimetype='text/html; charset=utf-8',
-                headers={
-                    'Content-Type': 'text/html; charset=utf-8',
-                    'Content-Disposition': 'inline',
-                    'X-Content-Type-Options': 'nosniff',
-                    'Cache-Control': 'no-cache'
-                }
+                headers=headers
             )
         else:
             # Fallback: try to serve raw mhtml (may prompt download)
+            # Only the header is read here to find the boundary; the body is streamed by send_file
             with open(file_path, 'rb') as f:
-                content = f.read()
+                head = f.read(2000)
             
             # Try to extract boundary for proper Content-Type
-            content_str = content[:2000].decode('utf-8', errors='ignore')
+            content_str = head.decode('utf-8', errors='ignore')
             boundary = None
-            import re
             for line in content_str.split('\n'):
                 if 'boundary=' in line.lower():
-                    match = re.search(r'boundary=["\']?([^"\'\s;]+)', line, re.IGNORECASE)
+                    match = _BOUNDARY_RE.search(line)
                     if match:
                         boundary = match.group(1)
                         break
             
             content_type = f'multipart/related; boundary="{boundary}"' if boundary else 'multipart/related'
             
-            return Response(
-                content,
-                mimetype=content_type,
-                headers={
-                    'Content-Type': content_type,
-                    'Content-Disposition': 'inline',
-                    'X-Content-Type-Options': 'nosniff'
-                }
-            )
+            response = send_file(file_path, mimetype=content_type, conditional=True)
+            response.headers['Content-Disposition'] = 'inline'
+            response.headers['X-Content-Type-Options'] = 'nosniff'
+            return response
     except Exception as e:
-        import traceback
         traceback.print_exc()
         return jsonify({'error': str(e)}), 404
 
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    if os.environ.get('FLASK_DEV'):
+        # Development: Werkzeug server with the debugger and reloader
+        app.run(debug=True, host='0.0.0.0', port=5000)
+    else:
+        # Production: multi-threaded WSGI server, so one slow mhtml extraction doesn't block other clients
+        try:
+            from waitress import serve
+        except ImportError:
+            print("waitress is not installed; falling back to the Flask development server")
+            app.run(host='0.0.0.0', port=5000, threaded=True)
+        else:
+            serve(app, host='0.0.0.0', port=5000, threads=8)
 